@@ -0,0 +1,25 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    timeline: {
+        // swap the per-date values into the figure already in the browser, the
+        // geometry and layout never travel again
+        update_map: function (frame, figure) {
+            if (!frame || !figure) {
+                return window.dash_clientside.no_update;
+            }
+            var trace = Object.assign({}, figure.data[0], frame);
+            return Object.assign({}, figure, {data: [trace]});
+        },
+
+        // advance the slider on every interval tick, wrapping at the last date
+        step: function (n_intervals, value, max) {
+            if (!n_intervals) {
+                return window.dash_clientside.no_update;
+            }
+            return value >= max ? 0 : value + 1;
+        },
+
+        toggle: function (n_clicks) {
+            return !(n_clicks % 2);
+        }
+    }
+});
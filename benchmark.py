@@ -0,0 +1,178 @@
+import argparse
+import concurrent.futures
+import fnmatch
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# name -> synthetic.write arguments (counties, days, countries, covid_days)
+SCENARIOS = {
+    'counties-30': (3142, 30, 200, 365),
+    'counties-180': (3142, 180, 200, 365),
+    'counties-365': (3142, 365, 200, 365),
+}
+
+# concurrent callback load: requests in flight at once and slider positions requested
+CONCURRENCY = int(os.environ.get('BENCHMARK_CONCURRENCY', 8))
+REQUESTS = int(os.environ.get('BENCHMARK_REQUESTS', 64))
+
+TIMELINE_REQUEST = {
+    'output': '..timeline_frame.data...stat_card_header.children..',
+    'changedPropIds': ['timeline_slider.value'],
+    'inputs': [{'id': 'timeline_slider', 'property': 'value', 'value': 0}],
+    'state': [{'id': 'timeline_version', 'property': 'data', 'value': None}],
+}
+
+
+def latencies(timings):
+    timings = np.asarray(timings)
+    return {
+        'requests': len(timings),
+        'p50_seconds': round(float(np.percentile(timings, 50)), 4),
+        'p95_seconds': round(float(np.percentile(timings, 95)), 4),
+        'max_seconds': round(float(timings.max()), 4),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    value = fn(*args)
+    return time.perf_counter() - start, value
+
+
+def load(server, version, indices):
+    """POST the timeline callback for every slider index from a page of snapshot `version`, CONCURRENCY at a time"""
+    def post(index):
+        body = dict(TIMELINE_REQUEST, inputs=[dict(TIMELINE_REQUEST['inputs'][0], value=int(index))],
+                    state=[dict(TIMELINE_REQUEST['state'][0], value=version)])
+        response = server.test_client().post('/_dash-update-component', json=body,
+                                             headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200, response.status_code
+        return len(response.data)
+
+    with concurrent.futures.ThreadPoolExecutor(CONCURRENCY) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda index: timed(post, index), indices))
+        wall = time.perf_counter() - start
+    stats = latencies([seconds for seconds, _ in results])
+    stats['requests_per_second'] = round(len(results) / wall, 1)
+    stats['response_bytes'] = int(np.median([size for _, size in results]))
+    return stats
+
+
+def worker():
+    """Runs inside the app's environment (COVID_DATA_PATH set), prints one JSON result"""
+    result = {}
+    start = time.perf_counter()
+    import main
+    result['startup'] = {'import_seconds': round(time.perf_counter() - start, 4)}
+
+    import payload
+    import refresh
+
+    snapshot = refresh.current()
+    timeline = snapshot.timeline
+    latest = len(timeline) - 1
+    result['data'] = {'counties': len(timeline.fips), 'dates': len(timeline),
+                      'covid_rows': len(snapshot.covid.data)}
+    result['getmap_fig'] = payload.measure(main.getmap_fig, timeline.snapshot(latest), timeline.zmin, timeline.zmax)
+    result['timeline_map'] = payload.measure(main.timeline_map.__wrapped__, snapshot, latest)
+
+    client = main.server.test_client()
+    layout_seconds, layout = timed(client.get, '/_dash-layout')
+    result['layout'] = {'seconds': round(layout_seconds, 4), 'json_bytes': len(layout.data),
+                        'gzip_bytes': len(gzip.compress(layout.data, 6))}
+
+    indices = np.random.default_rng(0).integers(0, len(timeline), REQUESTS)
+    result['callback'] = {'cold': load(main.server, snapshot.version, indices),
+                          'warm': load(main.server, snapshot.version, indices)}
+
+    covid = snapshot.covid
+    query = {'filters': {'REGION': list(covid.categories['region'][:3])}, 'split': 'COUNTRY', 'top': 10}
+    cold, _ = timed(lambda: covid.run(**query))
+    warm, _ = timed(lambda: covid.run(**query))
+    result['query'] = {'cold_seconds': round(cold, 4), 'warm_seconds': round(warm, 6)}
+
+    # VmHWM rather than ru_maxrss, which survives exec and would report the parent's peak from generating
+    # the data; the store was built by another process, as on a deploy
+    with open('/proc/self/status') as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+    result['peak_rss_mb'] = round(peak / 1024, 1)
+    json.dump(result, sys.stdout)
+
+
+def run_scenario(name, arguments, directory):
+    import synthetic
+
+    data = os.path.join(directory, name)
+    generate, _ = timed(synthetic.write, data, *arguments)
+    env = dict(os.environ, COVID_DATA_PATH=data, CACHE_DIR=os.path.join(directory, name + '-cache'),
+               REFRESH_INTERVAL='0')
+    here = os.path.dirname(os.path.abspath(__file__))
+    ingest, _ = timed(lambda: subprocess.run([sys.executable, os.path.join(here, 'columnar.py'), 'ingest'],
+                                             env=env, check=True, cwd=here, stdout=subprocess.DEVNULL))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), 'worker'], env=env, check=True,
+                            cwd=here, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    # anything the app printed on import comes before the result
+    result = json.loads(output.strip().splitlines()[-1])
+    result['startup']['ingest_seconds'] = round(ingest, 4)
+    result['generate_seconds'] = round(generate, 4)
+    return result
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        items = {}
+        for key, item in value.items():
+            items.update(flatten(item, '{}{}.'.format(prefix, key)))
+        return items
+    return {prefix[:-1]: value}
+
+
+def regressions(results, thresholds):
+    """Every metric over its threshold; thresholds map dotted paths (wildcards allowed) to maxima"""
+    failed = []
+    for path, value in flatten(results).items():
+        for pattern, limit in thresholds.items():
+            if fnmatch.fnmatchcase(path, pattern) and value > limit:
+                failed.append({'metric': path, 'value': value, 'threshold': limit})
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup, memory, payload and callback latency benchmarks '
+                                                 'over synthetic data')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=', '.join(SCENARIOS))
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--thresholds', help='JSON file of {"counties-30.callback.warm.p95_seconds": max, ...}')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='covid-bench-') as directory:
+        results = {name: run_scenario(name, SCENARIOS[name], directory) for name in args.scenarios}
+
+    report = {'scenarios': results}
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            report['regressions'] = regressions(results, json.load(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    # python benchmark.py [scenario ...] [--output results.json] [--thresholds thresholds.json]
+    if sys.argv[1:2] == ['worker']:
+        worker()
+    else:
+        sys.exit(main())
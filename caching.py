@@ -0,0 +1,91 @@
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import dash
+import numpy as np
+import pandas as pd
+import plotly
+from flask_caching import Cache
+from flask_compress import Compress
+
+from instrumentation import count_cache, phase
+
+cache = Cache()
+
+# version of the static inputs (e.g. geometry) and of the code mixed into every key; data snapshots passed
+# as arguments key on their own version, so a refresh retires their entries at once
+data_version = None
+
+PATH = pathlib.Path(__file__).parent
+
+
+def code_version():
+    """Digest of the app modules and the plotting libraries, a redeploy of changed code gets fresh keys"""
+    digest = hashlib.sha1('{} {}'.format(dash.__version__, plotly.__version__).encode())
+    for path in sorted(PATH.glob('*.py')):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:12]
+
+
+def init_cache(server, version):
+    """
+    Filesystem cache shared by every gunicorn worker on the host plus gzip for the responses.
+    CACHE_DIR / CACHE_THRESHOLD come from the environment. The threshold counts entries, not bytes: one is
+    ~50 KB (a timeline frame) to ~1 MB and more (a progression figure of every area), so the default 500 can
+    take hundreds of MB of CACHE_DIR. Past it, every third file is removed, whatever its age
+    """
+    global data_version
+    data_version = '{}-{}'.format(version, code_version())
+    cache.init_app(server, config={
+        'CACHE_TYPE': 'filesystem',
+        'CACHE_DIR': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'covid-dash-cache')),
+        'CACHE_THRESHOLD': int(os.environ.get('CACHE_THRESHOLD', 500)),
+        'CACHE_DEFAULT_TIMEOUT': 0,
+    })
+    Compress(server)
+
+
+def _normalize(value):
+    if hasattr(value, 'version'):
+        return ['version', value.version]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return ['frame', hashlib.sha1(pd.util.hash_pandas_object(value).to_numpy().tobytes()).hexdigest()]
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def make_key(name, args, kwargs):
+    inputs = json.dumps([_normalize(args), _normalize(kwargs)], sort_keys=True, default=str)
+    return '{}:{}:{}'.format(name, data_version, hashlib.sha1(inputs.encode()).hexdigest())
+
+
+def memoize(fn):
+    """
+    Cache `fn` results across workers, keyed by its normalized arguments and the dataset / code version.
+    Results are pickled: return plain dicts / lists, a go.Figure would be validated again on every hit
+    """
+    name = '{}.{}'.format(fn.__module__, fn.__name__)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with phase('cache'):
+            key = make_key(name, args, kwargs)
+            value = cache.get(key)
+        count_cache(value is not None)
+        if value is not None:
+            return value
+        value = fn(*args, **kwargs)
+        with phase('cache'):
+            cache.set(key, value)
+        return value
+
+    return wrapper
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# bump whenever the on-disk layout changes, old stores are then rebuilt instead of misread
+FORMAT_VERSION = 1
+
+PATH = pathlib.Path(__file__).parent
+# COVID_DATA_PATH points the app at another data folder, e.g. a synthetic one for benchmarks
+DATA_PATH = pathlib.Path(os.environ.get('COVID_DATA_PATH', PATH.joinpath("data"))).resolve()
+STORE_PATH = DATA_PATH.joinpath("store")
+
+SOURCES = {
+    'counties': DATA_PATH.joinpath("pickled_data_source"),
+    'covid': DATA_PATH.joinpath("covid.csv"),
+}
+
+# COLUMNAR_STORE=0 has the app read the sources whole into every worker, as before the store, for comparisons
+USE_STORE = os.environ.get('COLUMNAR_STORE', '1') != '0'
+
+
+def read_source(name):
+    """The frame exactly as the app used to load it"""
+    if name == 'covid':
+        from query import load_covid
+        return load_covid(SOURCES[name])
+    return pd.read_pickle(SOURCES[name])
+
+
+def _digest(path, chunk=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def source_version(source):
+    """
+    Content version of a source file. The digest is computed once per (path, size, mtime) and remembered
+    under STORE_PATH/signatures, so booting workers only stat the source instead of reading it
+    """
+    source = pathlib.Path(source).resolve()
+    stat = source.stat()
+    signature = hashlib.sha1(repr((str(source), stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()[:16]
+    pointer = STORE_PATH.joinpath('signatures', signature)
+    if pointer.exists():
+        return pointer.read_text()
+    version = 'v{}-{}'.format(FORMAT_VERSION, _digest(source))
+    pointer.parent.mkdir(parents=True, exist_ok=True)
+    partial = pointer.with_name('.{}-{}'.format(signature, os.getpid()))
+    partial.write_text(version)
+    partial.replace(pointer)
+    return version
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _encode(series, directory, index):
+    """Write one column, numbers as raw arrays and everything else dictionary encoded"""
+    entry = {'name': series.name}
+    if pd.api.types.is_datetime64_any_dtype(series):
+        entry.update(kind='datetime', file='{}.npy'.format(index))
+        np.save(directory.joinpath(entry['file']), series.to_numpy(dtype='datetime64[ns]').view(np.int64))
+    elif pd.api.types.is_numeric_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        entry.update(kind='numeric', file='{}.npy'.format(index))
+        np.save(directory.joinpath(entry['file']), series.to_numpy())
+    else:
+        values = series.astype(object) if isinstance(series.dtype, pd.CategoricalDtype) else series
+        codes, categories = pd.factorize(values.map(_hashable))
+        dtype = np.int16 if len(categories) < 2 ** 15 else np.int32
+        entry.update(kind='dictionary', file='{}.npy'.format(index),
+                     categorical=isinstance(series.dtype, pd.CategoricalDtype),
+                     categories=[list(value) if isinstance(value, tuple) else value for value in categories])
+        np.save(directory.joinpath(entry['file']), codes.astype(dtype))
+    return entry
+
+
+def ingest(name, frame=None, source=None):
+    """
+    Convert a source into the columnar store, returns the store directory. `frame` / `source`
+    store an already prepared frame versioned by the file it came from (e.g. a daily extract)
+    """
+    version = source_version(source or SOURCES[name])
+    target = STORE_PATH.joinpath(name, version)
+    if target.exists():
+        return target
+    frame = read_source(name) if frame is None else frame
+
+    partial = STORE_PATH.joinpath(name, '.{}-{}'.format(version, os.getpid()))
+    shutil.rmtree(partial, ignore_errors=True)
+    partial.mkdir(parents=True)
+    columns = [_encode(frame[column], partial, index) for index, column in enumerate(frame.columns)]
+    meta = {'format': FORMAT_VERSION, 'version': version, 'rows': len(frame), 'columns': columns}
+    partial.joinpath('meta.json').write_text(json.dumps(meta))
+    try:
+        partial.rename(target)
+    except OSError:
+        # another worker finished the same ingest first
+        shutil.rmtree(partial, ignore_errors=True)
+    return target
+
+
+class Store:
+    """Read side of one store: columns are memory-mapped on first use and shared through the page cache"""
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        meta = json.loads(self.directory.joinpath('meta.json').read_text())
+        self.version = meta['version']
+        self.rows = meta['rows']
+        self.meta = {entry['name']: entry for entry in meta['columns']}
+        self.columns = list(self.meta)
+        self._arrays = {}
+
+    def array(self, column):
+        """Raw memory-mapped values, the codes for dictionary columns"""
+        if column not in self._arrays:
+            self._arrays[column] = np.load(self.directory.joinpath(self.meta[column]['file']), mmap_mode='r')
+        return self._arrays[column]
+
+    def categories(self, column):
+        return self.meta[column]['categories']
+
+    def column(self, column):
+        entry = self.meta[column]
+        values = self.array(column)
+        if entry['kind'] == 'datetime':
+            return pd.Series(values.view('datetime64[ns]'), name=column)
+        if entry['kind'] == 'numeric':
+            return pd.Series(values, name=column, copy=False)
+        if entry.get('categorical'):
+            categories = pd.Index(entry['categories'])
+            return pd.Series(pd.Categorical.from_codes(np.asarray(values, dtype=np.int64), categories), name=column)
+        categories = np.empty(len(entry['categories']) + 1, dtype=object)
+        categories[:-1] = entry['categories']
+        categories[-1] = np.nan
+        return pd.Series(categories[values], name=column)
+
+    def frame(self, columns=None):
+        """Decode `columns` (all by default) into a DataFrame, only those pages are ever touched"""
+        return pd.concat([self.column(column) for column in (columns or self.columns)], axis=1)
+
+
+class SourceFrame:
+    """Store stand-in over the source read whole into this process (COLUMNAR_STORE=0)"""
+
+    def __init__(self, name):
+        self.data = read_source(name)
+        self.version = source_version(SOURCES[name])
+        self.columns = list(self.data.columns)
+
+    def frame(self, columns=None):
+        return self.data[columns or self.columns]
+
+
+def open_store(name):
+    """Open the current store for `name`, ingesting the source first if it changed"""
+    if not USE_STORE:
+        return SourceFrame(name)
+    return Store(ingest(name))
+
+
+def _worker():
+    # one simulated gunicorn worker: import the app, report, then stay alive until the parent has
+    # measured every worker side by side; what it holds includes the timeline matrices and query indexes
+    start = time.perf_counter()
+    import main  # noqa: F401
+    elapsed = time.perf_counter() - start
+
+    with open('/proc/self/smaps_rollup') as f:
+        memory = {line.split(':')[0]: int(line.split()[1]) for line in f if line.split()[-1] == 'kB'}
+    with open('/proc/self/status') as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+    print(json.dumps({'import_seconds': round(elapsed, 4), 'peak_rss_kb': peak, 'rss_kb': memory['Rss'],
+                      'pss_kb': memory['Pss']}), flush=True)
+    sys.stdin.read()
+
+
+def report(workers=4):
+    """Per-worker app import time and memory, reading the sources (pickle) vs the store, `workers` at a time"""
+    for name in SOURCES:
+        ingest(name)
+    results = {}
+    for mode, flag in (('pickle', '0'), ('store', '1')):
+        env = dict(os.environ, COLUMNAR_STORE=flag, REFRESH_INTERVAL='0')
+        procs = [subprocess.Popen([sys.executable, __file__, 'worker'], cwd=str(PATH), env=env,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+                 for _ in range(workers)]
+        stats = [json.loads(proc.stdout.readline()) for proc in procs]
+        for proc in procs:
+            proc.communicate('')
+        results[mode] = {key: round(sum(stat[key] for stat in stats) / workers, 4) for key in stats[0]}
+    return results
+
+
+if __name__ == '__main__':
+    # python columnar.py [ingest|report|worker]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'ingest'
+    if command == 'worker':
+        _worker()
+    elif command == 'report':
+        print(json.dumps(report(), indent=2))
+    else:
+        for source in SOURCES:
+            print(ingest(source))
@@ -0,0 +1,277 @@
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import time
+from urllib.request import urlopen
+
+COUNTIES_URL = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
+
+# bump whenever the simplification or the artifact layout changes; built artifacts are named after
+# the source digest and served under the digest of their own bytes, so browsers never keep a stale copy
+GEOMETRY_VERSION = 2
+
+# quantization grid in decimal degrees (3 -> ~100m) and simplification
+# tolerance in grid units (5 -> ~500m); both stay under a pixel at the map zoom levels
+PRECISION = 3
+TOLERANCE = 5
+
+PATH = pathlib.Path(__file__).parent
+GEO_PATH = PATH.joinpath("data", "geo").resolve()
+
+
+def load_source(source=COUNTIES_URL):
+    """The source geojson and the digest of its bytes"""
+    source = str(source)
+    if source.startswith(('http://', 'https://')):
+        with urlopen(source) as response:
+            raw = response.read()
+    else:
+        raw = pathlib.Path(source).read_bytes()
+    return json.loads(raw), hashlib.sha1(raw).hexdigest()[:12]
+
+
+def source_name(digest):
+    return 'counties-v{}-{}.json.gz'.format(GEOMETRY_VERSION, digest)
+
+
+def _polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+
+def _quantize(ring, scale):
+    points = []
+    for lon, lat in (coord[:2] for coord in ring):
+        point = (int(round(lon * scale)), int(round(lat * scale)))
+        if not points or points[-1] != point:
+            points.append(point)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+
+def _simplify(arc, tolerance):
+    # Douglas-Peucker on an open arc; both end points are always kept
+    if len(arc) < 3:
+        return list(arc)
+    keep = [False] * len(arc)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(arc) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = arc[first], arc[last]
+        dx, dy = x2 - x1, y2 - y1
+        norm = (dx * dx + dy * dy) ** 0.5
+        index, distance = 0, 0.0
+        for i in range(first + 1, last):
+            x, y = arc[i]
+            if norm:
+                d = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                d = ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
+            if d > distance:
+                index, distance = i, d
+        if distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(arc, keep) if kept]
+
+
+def _junctions(rings):
+    # a vertex is a junction when it is reached with different neighbours in
+    # different rings; splitting there gives arcs that are identical between
+    # the features sharing them, so they simplify identically (no gaps/slivers)
+    neighbours, junctions = {}, set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+
+def _simplify_ring(ring, junctions, arcs, tolerance):
+    cuts = [i for i, point in enumerate(ring) if point in junctions]
+    if not cuts:
+        # closed ring not shared piecewise: anchor on its smallest vertex so
+        # both copies of a shared ring (e.g. an enclave) start at the same place
+        start = ring.index(min(ring))
+        ring = ring[start:] + ring[:start]
+        far = max(range(len(ring)), key=lambda i: (ring[i][0] - ring[0][0]) ** 2 + (ring[i][1] - ring[0][1]) ** 2)
+        cuts = [0, far] if far else [0]
+    else:
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [i - cuts[0] for i in cuts]
+    ring = ring + ring[:1]
+    result = []
+    for first, last in zip(cuts, cuts[1:] + [len(ring) - 1]):
+        arc = tuple(ring[first:last + 1])
+        reverse = arc[::-1]
+        key = min(arc, reverse)
+        if key not in arcs:
+            arcs[key] = _simplify(key, tolerance)
+        simplified = arcs[key] if key == arc else arcs[key][::-1]
+        result.extend(point for point in simplified[:-1] if not result or result[-1] != point)
+    while len(result) > 1 and result[-1] == result[0]:
+        result.pop()
+    return result
+
+
+def simplify_features(features, precision=PRECISION, tolerance=TOLERANCE):
+    scale = 10 ** precision
+    shapes = []
+    for feature in features:
+        polygons = [[_quantize(ring, scale) for ring in polygon] for polygon in _polygons(feature['geometry'])]
+        polygons = [[ring for ring in polygon if len(ring) >= 3] for polygon in polygons]
+        shapes.append((feature['id'], [polygon for polygon in polygons if polygon]))
+
+    junctions = _junctions(ring for _, polygons in shapes for polygon in polygons for ring in polygon)
+    arcs = {}
+    simplified = []
+    for fips, polygons in shapes:
+        coordinates = []
+        for polygon in polygons:
+            rings = []
+            for index, ring in enumerate(polygon):
+                points = _simplify_ring(ring, junctions, arcs, tolerance)
+                if len(points) < 3:
+                    # collapsed outer rings fall back to the quantized shape,
+                    # collapsed holes are dropped
+                    if index:
+                        continue
+                    points = ring
+                points = points + points[:1]
+                rings.append([[x / scale, y / scale] for x, y in points])
+            coordinates.append(rings)
+        geometry = ({'type': 'Polygon', 'coordinates': coordinates[0]} if len(coordinates) == 1 else
+                    {'type': 'MultiPolygon', 'coordinates': coordinates})
+        simplified.append({'type': 'Feature', 'id': fips, 'properties': {}, 'geometry': geometry})
+    return simplified
+
+
+def build_counties(source=COUNTIES_URL, directory=GEO_PATH):
+    """Simplify every county shape of `source` into a gzipped artifact named after the source digest"""
+    data, digest = load_source(source)
+    geojson = {'type': 'FeatureCollection', 'features': simplify_features(data['features'])}
+    payload = json.dumps(geojson, separators=(',', ':')).encode()
+
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory.joinpath(source_name(digest))
+    # one temp file per process, workers may build at the same time
+    partial = directory.joinpath('{}.{}.tmp'.format(target.name, os.getpid()))
+    partial.write_bytes(gzip.compress(payload, 9, mtime=0))
+    partial.replace(target)
+    return target
+
+
+class Artifact:
+    """Gzipped county shapes named after their own bytes, so the URL can be cached forever"""
+
+    def __init__(self, compressed):
+        self.compressed = compressed
+        self.etag = hashlib.sha1(compressed).hexdigest()
+        self.name = 'counties-v{}-{}.json'.format(GEOMETRY_VERSION, self.etag[:12])
+
+
+def built_artifact(directory=GEO_PATH):
+    """The artifact built for this GEOMETRY_VERSION, the most recent one if several sources were built"""
+    built = sorted(pathlib.Path(directory).glob(source_name('*')), key=lambda path: path.stat().st_mtime)
+    if not built:
+        raise RuntimeError('no county geometry in {}, build it with `python geometry.py [source]`'.format(directory))
+    return built[-1]
+
+
+def counties_artifact(fips, directory=GEO_PATH):
+    """
+    The shapes of the `fips` counties, cut from the built artifact; never reaches the network, a missing
+    artifact or county is an error rather than a download at import
+    """
+    compressed = built_artifact(directory).read_bytes()
+    features = json.loads(gzip.decompress(compressed))['features']
+    wanted = set(fips)
+    missing = wanted.difference(feature['id'] for feature in features)
+    if missing:
+        raise RuntimeError('{} FIPS codes have no shape in {}, e.g. {}'.format(
+            len(missing), built_artifact(directory).name, sorted(missing)[:5]))
+    if len(wanted) < len(features):
+        geojson = {'type': 'FeatureCollection', 'features': [feature for feature in features if feature['id'] in wanted]}
+        compressed = gzip.compress(json.dumps(geojson, separators=(',', ':')).encode(), 9, mtime=0)
+    return Artifact(compressed)
+
+
+def artifact_url(app, artifact):
+    """The URL `artifact` is served under by serve_artifacts"""
+    return '{}geo/{}'.format(app.config.requests_pathname_prefix, artifact.name)
+
+
+def serve_artifacts(app, current):
+    """
+    Serve county shapes from the dash app with an immutable cache header. `current` returns the artifact of
+    the snapshot this worker serves and is looked up per request, so every worker answers for the URL of
+    its snapshot whichever worker built the figure; artifacts served once stay available to older pages
+    """
+    import flask
+
+    served = {}
+
+    @app.server.route('{}geo/<name>'.format(app.config.routes_pathname_prefix), endpoint='geometry')
+    def geometry(name):
+        artifact = current()
+        served.setdefault(artifact.name, artifact)
+        artifact = served.get(name)
+        if artifact is None:
+            flask.abort(404)
+        if flask.request.if_none_match.contains(artifact.etag):
+            response = flask.Response(status=304)
+        elif 'gzip' in flask.request.accept_encodings:
+            response = flask.Response(artifact.compressed, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = flask.Response(gzip.decompress(artifact.compressed), mimetype='application/json')
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(artifact.etag)
+        return response
+
+
+def report(source=COUNTIES_URL):
+    """Compare the raw source geojson with the simplified artifact: bytes on the wire and parse time"""
+    start = time.perf_counter()
+    raw, _ = load_source(source)
+    raw_load = time.perf_counter() - start
+    raw_bytes = len(json.dumps(raw).encode())
+
+    start = time.perf_counter()
+    artifact = build_counties(source)
+    build = time.perf_counter() - start
+
+    compressed = artifact.read_bytes()
+    start = time.perf_counter()
+    json.loads(gzip.decompress(compressed))
+    artifact_load = time.perf_counter() - start
+
+    return {
+        'source_bytes': raw_bytes,
+        'source_gzip_bytes': len(gzip.compress(json.dumps(raw).encode(), 6)),
+        'source_load_seconds': round(raw_load, 3),
+        'artifact': artifact.name,
+        'artifact_bytes': len(gzip.decompress(compressed)),
+        'artifact_gzip_bytes': len(compressed),
+        'artifact_load_seconds': round(artifact_load, 3),
+        'build_seconds': round(build, 3),
+    }
+
+
+if __name__ == '__main__':
+    # python geometry.py [source] -- build the artifact of every county in the source, the app cuts its FIPS set out
+    print(json.dumps(report(*sys.argv[1:2]), indent=2))
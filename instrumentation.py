@@ -0,0 +1,228 @@
+import collections
+import contextlib
+import heapq
+import ipaddress
+import itertools
+import os
+import sys
+import threading
+import time
+
+import flask
+
+# upper bounds (ms) of the latency histogram buckets, the last one catches everything slower
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+# PROFILE_SLOWEST > 0 turns the sampling profiler on and keeps the stacks of that many slowest requests,
+# PROFILE_INTERVAL is the sampling period in seconds
+PROFILE_SLOWEST = int(os.environ.get('PROFILE_SLOWEST', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+
+_local = threading.local()
+_lock = threading.Lock()
+_metrics = {}
+_active = {}
+_slowest = []
+_counter = itertools.count()
+
+
+class Timer:
+    """Wall time of one request split by phase; only the innermost running phase is charged (self time)"""
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.phases = collections.Counter()
+        self.cache = collections.Counter()
+        self.stack = []
+        self.stacks = collections.Counter()
+        self.view_done = None
+        self.raw_bytes = None
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.phases[self.stack[-1][0]] += now - self.stack[-1][1]
+        self.stack.append([name, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        name, start = self.stack.pop()
+        self.phases[name] += now - start
+        if self.stack:
+            self.stack[-1][1] = now
+
+
+def current():
+    """The Timer of the request served by this thread, None outside of a request"""
+    return getattr(_local, 'timer', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Charge the time spent in the block (or decorated function) to `name` in the current request"""
+    timer = current()
+    if timer is None:
+        yield
+        return
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.exit()
+
+
+def count_cache(hit):
+    timer = current()
+    if timer is not None:
+        timer.cache['hits' if hit else 'misses'] += 1
+
+
+def _label():
+    request = flask.request
+    if request.path.endswith('_dash-update-component'):
+        body = request.get_json(silent=True) or {}
+        return 'callback {}'.format(body.get('output', '?'))
+    return '{} {}'.format(request.method, request.url_rule.rule if request.url_rule else request.path)
+
+
+def _start():
+    _local.timer = Timer(_label())
+    if PROFILE_SLOWEST:
+        _active[threading.get_ident()] = _local.timer
+
+
+def _view_done(response):
+    # runs first of the after_request hooks, so before any compression
+    timer = current()
+    if timer is not None:
+        timer.view_done = time.perf_counter()
+        if not response.direct_passthrough:
+            timer.raw_bytes = len(response.get_data())
+    return response
+
+
+def _finish(response):
+    # runs last of the after_request hooks, the response is in its final (compressed) form
+    timer = current()
+    if timer is None:
+        return response
+    end = time.perf_counter()
+    view = (timer.view_done or end) - timer.start
+    phases = dict(timer.phases)
+    # whatever the view did outside a named phase: dash dispatch, mostly JSON serialization
+    phases['dispatch'] = max(view - sum(phases.values()), 0)
+    phases['compress'] = end - (timer.view_done or end)
+    total = end - timer.start
+    sent = None if response.direct_passthrough else len(response.get_data())
+
+    timings = ['{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in phases.items()]
+    timings.append('total;dur={:.2f}'.format(total * 1000))
+    if timer.cache:
+        timings.append('cache-hits;desc="hits={} misses={}"'.format(timer.cache['hits'], timer.cache['misses']))
+    if timer.raw_bytes is not None:
+        timings.append('bytes;desc="raw={} sent={}"'.format(timer.raw_bytes, sent))
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    _record(timer, phases, total, sent)
+    return response
+
+
+def _record(timer, phases, total, sent):
+    with _lock:
+        metric = _metrics.get(timer.label)
+        if metric is None:
+            metric = _metrics[timer.label] = {
+                'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'histogram': [0] * len(BUCKETS),
+                'phases': collections.Counter(), 'cache': collections.Counter(),
+                'raw_bytes': 0, 'sent_bytes': 0,
+            }
+        metric['count'] += 1
+        metric['seconds'] += total
+        metric['max_seconds'] = max(metric['max_seconds'], total)
+        metric['histogram'][next(i for i, bound in enumerate(BUCKETS) if total * 1000 <= bound)] += 1
+        metric['phases'].update(phases)
+        metric['cache'].update(timer.cache)
+        metric['raw_bytes'] += timer.raw_bytes or 0
+        metric['sent_bytes'] += sent or 0
+
+        if PROFILE_SLOWEST and timer.stacks:
+            entry = (total, next(_counter), timer.label, timer.stacks)
+            if len(_slowest) < PROFILE_SLOWEST:
+                heapq.heappush(_slowest, entry)
+            else:
+                heapq.heappushpop(_slowest, entry)
+
+
+def _teardown(exc):
+    _active.pop(threading.get_ident(), None)
+    _local.timer = None
+
+
+def _frames(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def _sample():
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        frames = sys._current_frames()
+        for ident, timer in list(_active.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                timer.stacks[_frames(frame)] += 1
+
+
+def _local_only():
+    address = ipaddress.ip_address(flask.request.remote_addr or '127.0.0.1')
+    if not address.is_loopback:
+        flask.abort(404)
+
+
+def metrics():
+    """Per request / callback counts, latency histogram, phase totals, bytes and cache hits of this process"""
+    _local_only()
+    with _lock:
+        report = {}
+        for label, metric in _metrics.items():
+            report[label] = dict(metric, phases={name: round(seconds, 6) for name, seconds in metric['phases'].items()},
+                                 cache=dict(metric['cache']))
+    # histogram[i] counts the requests up to buckets_ms[i], the extra last count the slower ones
+    return flask.jsonify(pid=os.getpid(), buckets_ms=BUCKETS[:-1], requests=report)
+
+
+def profile():
+    """Collapsed stacks of the slowest requests, ready for flamegraph.pl or speedscope"""
+    _local_only()
+    if not PROFILE_SLOWEST:
+        flask.abort(404)
+    with _lock:
+        slowest = sorted(_slowest, reverse=True)
+    lines = []
+    for total, _, label, stacks in slowest:
+        root = '{} [{:.0f}ms]'.format(label.replace(';', ','), total * 1000)
+        lines.extend('{};{} {}'.format(root, stack, count) for stack, count in stacks.items())
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
+def init_instrumentation(server, prefix='/'):
+    """
+    Time every request by phase, add Server-Timing headers and serve the process metrics on
+    <prefix>_metrics (loopback only) plus the profiler's <prefix>_metrics/profile when PROFILE_SLOWEST is set.
+    Call it after everything else registering after_request hooks (e.g. compression)
+    """
+    server.before_request_funcs.setdefault(None, []).insert(0, _start)
+    # flask runs after_request hooks in reverse: the last registered first, the first registered last
+    hooks = server.after_request_funcs.setdefault(None, [])
+    hooks.insert(0, _finish)
+    hooks.append(_view_done)
+    server.teardown_request(_teardown)
+    server.add_url_rule('{}_metrics'.format(prefix), 'metrics', metrics)
+    server.add_url_rule('{}_metrics/profile'.format(prefix), 'profile', profile)
+    if PROFILE_SLOWEST:
+        threading.Thread(target=_sample, name='request-profiler', daemon=True).start()
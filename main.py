@@ -2,24 +2,29 @@ import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
-import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
-from urllib.request import urlopen
-import json
 import pathlib
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
-with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json') as response:
-    counties = json.load(response)
+import geometry
+import progression
+import refresh
+from constants import md1
+from query import DIMENSIONS
+from caching import init_cache, memoize
+from instrumentation import init_instrumentation, phase
 
 # get relative data folder
 PATH = pathlib.Path(__file__).parent
 DATA_PATH = PATH.joinpath("data").resolve()
 
-pickled_data_source = DATA_PATH.joinpath("pickled_data_source")
-
-df = pd.read_pickle(pickled_data_source)
+# the data (county x date matrices behind the map, covid.csv query engine and the simplified county shapes
+# cut from the prebuilt geometry artifact) is a snapshot read from the memory-mapped columnar store and
+# swapped by a background refresh as new extracts land
 
 
+@phase('hover')
 def get_hover_text(df):
     county_name_text = "<b>{}</b><br>Calculated NPI score: {}<br>Social distancing index: {}<br>Imported COVID cases: {}<br>"
     return [county_name_text.format(ctname, npiscore, socdisind, covidcases) for
@@ -27,21 +32,52 @@ def get_hover_text(df):
             zip(df['state'], df['npi_score'], df['Social distancing index'], df['Imported COVID cases'])]
 
 
-def getmap_fig(df):
-    z_min = df['npi_score'].min()
-    z_max = df['npi_score'].max()
+# same text as get_hover_text, rendered by plotly.js from the values already in the figure
+hover_template = "<b>%{text}</b><br>Calculated NPI score: %{z}<br>Social distancing index: %{customdata[0]}<br>" \
+                 "Imported COVID cases: %{customdata[1]}<br><extra></extra>"
+
+
+def compact_values(values, decimals=4):
+    values = np.round(np.asarray(values, dtype=float), decimals)
+    if np.all(values % 1 == 0):
+        return values.astype(int).tolist()
+    return values.tolist()
+
+
+@phase('hover')
+def get_hover_data(df):
+    return [list(row) for row in zip(compact_values(df['Social distancing index']),
+                                     compact_values(df['Imported COVID cases']))]
+
+
+@phase('figure')
+def getmap_fig(df, z_min=None, z_max=None, compact=True, geojson=None):
+    """
+    compact ships the raw values once (rounded z, hover numbers as customdata, state names as text)
+    and lets hovertemplate build the hover labels in the browser; compact=False sends preformatted
+    hover strings per county. `geojson` is the URL of shapes for df's counties, those of the snapshot
+    served at startup by default
+    """
+    z_min = df['npi_score'].min() if z_min is None else z_min
+    z_max = df['npi_score'].max() if z_max is None else z_max
 
-    hover_text = get_hover_text(df)
+    if compact:
+        hover = dict(z=compact_values(df['npi_score']),
+                     text=df['state'].tolist(),
+                     customdata=get_hover_data(df),
+                     hovertemplate=hover_template)
+    else:
+        hover = dict(z=df['npi_score'],
+                     text=get_hover_text(df),
+                     hoverinfo='text')
 
-    fig = go.Figure(go.Choroplethmapbox(geojson=counties,
-                                        locations=df['CTFIPS'],
-                                        z=df['npi_score'],
+    fig = go.Figure(go.Choroplethmapbox(geojson=geojson or counties,
+                                        locations=df['CTFIPS'].tolist(),
                                         colorscale="Viridis",
                                         zmin=z_min,
                                         zmax=z_max,
                                         marker_line_width=0,
-                                        text=hover_text,
-                                        hoverinfo='text'
+                                        **hover
                                         ))
 
     fig.update_layout(
@@ -58,8 +94,6 @@ def getmap_fig(df):
     return fig
 
 
-rendered_map = getmap_fig(df)
-
 # link href="https://fonts.googleapis.com/css2?family=Open+Sans:wght@300&display=swap" rel="stylesheet"
 app = dash.Dash(__name__,
                 external_stylesheets=[dbc.themes.BOOTSTRAP,
@@ -95,6 +129,28 @@ app.title = 'COVID-19 Analytical Report'
 server = app.server
 app.config.suppress_callback_exceptions = True
 
+# callback / figure results shared by all workers, keyed by the data they were built from
+init_cache(server, 'geometry-v{}'.format(geometry.GEOMETRY_VERSION))
+
+# Server-Timing per phase (data / hover / figure / cache / dispatch / compress) and a local /_metrics endpoint,
+# registered after compression so the bytes actually sent are counted
+init_instrumentation(server, app.config.routes_pathname_prefix)
+
+# the figure only references the geometry by URL, browsers fetch it once and keep it
+geometry.serve_artifacts(app, lambda: refresh.current().geometry)
+counties = geometry.artifact_url(app, refresh.current().geometry)
+
+
+@memoize
+def timeline_map(snapshot, index):
+    # scaled over the whole timeline so colours stay comparable across dates
+    timeline = snapshot.timeline
+    with phase('data'):
+        frame = timeline.snapshot(index)
+    # a reload with another FIPS set brings its own shapes, served by every worker on that snapshot
+    url = geometry.artifact_url(app, snapshot.geometry)
+    return getmap_fig(frame, timeline.zmin, timeline.zmax, geojson=url).to_plotly_json()
+
 config = {'modeBarButtonsToRemove': ['pan2d', 'select2d', 'lasso2d', 'zoomOut2d', 'zoomIn2d', 'hoverClosestCartesian',
                                      'zoom2d', 'autoScale2d', 'hoverCompareCartesian', 'zoomInGeo', 'zoomOutGeo',
                                      'hoverClosestGeo', 'hoverClosestGl2d', 'toggleHover',
@@ -105,23 +161,160 @@ config = {'modeBarButtonsToRemove': ['pan2d', 'select2d', 'lasso2d', 'zoomOut2d'
 MAPS SECTION CONTAINER
 TODOS 
 1. ADD INTERACTIVITY TO THE MAP
-2. DISPLAY TIMELINE DATA
 
 '''
-map_section = dbc.Container([
-    dbc.Row([
-        html.Div(id='output-clientside', style={'height': '5vh'}),
-        dbc.Col(dcc.Graph(id='map_plot', config=config, figure=rendered_map, style={'height': '78vh'}), width=12),
-    ]),
 
-    dbc.Card([
-        dbc.CardHeader(
-            html.H2("", id='stat_card_header', className='m-0',
-                    style={'color': '#508caf'})
-            , style={'backgroundColor': 'rgba(255,255,255,0.5)'})
-    ], style={'backgroundColor': 'rgba(255,255,255,0.5)', 'left': '3vw', 'top': '-25vh', 'width': '242px'}),
 
-], fluid=True, id='map_section', style={'height': '90vh'})
+def create_map_section(snapshot):
+    timeline = snapshot.timeline
+    # start on the latest date
+    latest = len(timeline) - 1
+
+    return dbc.Container([
+        dbc.Row([
+            html.Div(id='output-clientside', style={'height': '5vh'}),
+            dbc.Col(dcc.Graph(id='map_plot', config=config, figure=timeline_map(snapshot, latest),
+                              style={'height': '78vh'}), width=12),
+        ]),
+
+        dbc.Card([
+            dbc.CardHeader(
+                html.H2(timeline.label(latest), id='stat_card_header', className='m-0',
+                        style={'color': '#508caf'})
+                , style={'backgroundColor': 'rgba(255,255,255,0.5)'})
+        ], style={'backgroundColor': 'rgba(255,255,255,0.5)', 'left': '3vw', 'top': '-25vh', 'width': '242px'}),
+
+        dbc.Row([
+            dbc.Col(dbc.Button(html.I(className='material-icons', children='play_arrow'), id='timeline_play',
+                               color='link', n_clicks=0), width='auto'),
+            dbc.Col(dcc.Slider(id='timeline_slider', min=0, max=latest, value=latest,
+                               marks=timeline.marks(), updatemode='drag'), className='pt-2'),
+            dcc.Interval(id='timeline_interval', interval=500, disabled=True),
+            dcc.Store(id='timeline_frame'),
+            # frames only fit the figure (counties, dates) of the snapshot the page was built from
+            dcc.Store(id='timeline_version', data=snapshot.version),
+        ], align='center', style={'marginTop': '-10vh'}),
+
+    ], fluid=True, id='map_section', style={'height': '90vh'})
+
+'''
+TIMELINE CALLBACKS
+only the per-date values go over the wire, the browser patches them into the figure it already has
+'''
+
+
+@app.callback([Output('timeline_frame', 'data'), Output('stat_card_header', 'children')],
+              [Input('timeline_slider', 'value')],
+              [State('timeline_version', 'data')])
+def update_timeline_frame(index, version):
+    snapshot = refresh.current()
+    if version != snapshot.version:
+        # the page holds another snapshot's counties and dates, its figure cannot take this one's values
+        return dash.no_update, 'New data, reload the page'
+    return timeline_frame(snapshot, index)
+
+
+@memoize
+def timeline_frame(snapshot, index):
+    timeline = snapshot.timeline
+    index = min(index, len(timeline) - 1)
+    with phase('data'):
+        frame = timeline.snapshot(index)
+    with phase('figure'):
+        z = compact_values(frame['npi_score'])
+    return {'z': z, 'customdata': get_hover_data(frame)}, timeline.label(index)
+
+
+app.clientside_callback(ClientsideFunction(namespace='timeline', function_name='update_map'),
+                        Output('map_plot', 'figure'),
+                        [Input('timeline_frame', 'data')],
+                        [State('map_plot', 'figure')])
+
+app.clientside_callback(ClientsideFunction(namespace='timeline', function_name='step'),
+                        Output('timeline_slider', 'value'),
+                        [Input('timeline_interval', 'n_intervals')],
+                        [State('timeline_slider', 'value'), State('timeline_slider', 'max')])
+
+app.clientside_callback(ClientsideFunction(namespace='timeline', function_name='toggle'),
+                        Output('timeline_interval', 'disabled'),
+                        [Input('timeline_play', 'n_clicks')])
+
+'''
+PROGRESSION SECTION
+the model in data/model_parameters.csv is compiled once and scored for every area and date in one go per
+data snapshot and model version (see progression.Model), a filter selection only picks rows out of that projection
+'''
+model = progression.Model()
+
+
+@memoize
+def projection(snapshot, model):
+    with phase('data'):
+        return progression.project(snapshot.covid, model)
+
+
+@phase('figure')
+def getprogression_fig(projection, areas):
+    # plain dicts: going through go.Scatter validation costs more than the scoring itself for many areas
+    days = projection.dates.strftime('%Y-%m-%d')
+    data = []
+    for area in areas:
+        row = projection.areas.get_loc(area)
+        shown = ~np.isnan(projection.fit[row])
+        x = days[shown].tolist()
+        data.append({'type': 'scatter', 'x': x + x[::-1], 'fill': 'toself', 'line': {'width': 0}, 'opacity': 0.2,
+                     'y': compact_values(np.concatenate([projection.upper[row][shown],
+                                                         projection.lower[row][shown][::-1]])),
+                     'hoverinfo': 'skip', 'legendgroup': area, 'showlegend': False, 'name': area})
+        data.append({'type': 'scatter', 'x': x, 'y': compact_values(projection.fit[row][shown]), 'mode': 'lines',
+                     'legendgroup': area, 'name': area})
+    last = projection.last_observed.strftime('%Y-%m-%d')
+    title = 'Model score (linear predictor, 95% CI)'
+    if projection.illustrative:
+        title = 'Illustrative projection: country groups and time scaling estimated from the current data, ' \
+                'not those of the fit'
+    layout = {'margin': {'l': 40, 'r': 0, 't': 40, 'b': 30}, 'hovermode': 'x', 'template': 'plotly_white',
+              'title': {'text': title, 'font': {'size': 13}},
+              'yaxis': {'title': {'text': 'Model score (95% CI)'}},
+              'shapes': [{'type': 'line', 'xref': 'x', 'yref': 'paper', 'x0': last, 'x1': last, 'y0': 0, 'y1': 1,
+                          'line': {'dash': 'dot', 'color': '#999999'}}]}
+    return {'data': data, 'layout': layout}
+
+
+@memoize
+def progression_figure(snapshot, model, filters, top):
+    covid = snapshot.covid
+    filters, _, top, _ = covid.normalize(filters, top=top)
+    rows = np.flatnonzero(covid.mask(filters))
+    latest = covid.data.iloc[rows].groupby('country_area', observed=True)['confirmed_cases'].last()
+    projected = projection(snapshot, model)
+    areas = [area for area in latest.sort_values(ascending=False).index if area in projected.areas]
+    return getprogression_fig(projected, areas[:top])
+
+
+def create_progression_section(snapshot):
+    covid = snapshot.covid
+    filters = [dbc.Col(dcc.Dropdown(id='progression_{}'.format(column), placeholder=label, multi=True,
+                                    options=[{'label': name, 'value': name} for name in covid.categories[column]]),
+                       md=3) for label, column in DIMENSIONS.items()]
+
+    return dbc.Container([
+        html.H4('Progression', className='mb-4'),
+        dbc.Row(filters + [
+            dbc.Col(dbc.Input(id='progression_top', type='number', min=1, value=10, placeholder='Top'), md=2),
+        ], className='mb-2'),
+        dcc.Graph(id='progression_plot', config=config, style={'height': '60vh'}),
+        dcc.Markdown(md1),
+    ], fluid=True, id='progression', className='mb-4')
+
+
+@app.callback(Output('progression_plot', 'figure'),
+              [Input('progression_{}'.format(column), 'value') for column in DIMENSIONS.values()]
+              + [Input('progression_top', 'value')])
+def update_progression(*values):
+    filters = dict(zip(DIMENSIONS, values[:-1]))
+    # an emptied top field shows every area, like an empty 'Limit Split to Top'
+    return progression_figure(refresh.current(), model, filters, values[-1])
 
 '''
 NAVBAR LAYOUT
@@ -166,12 +359,22 @@ footer_section = dbc.Container([
 
 '''
 APP LAYOUT SECTION
+rebuilt per page load, so a refreshed snapshot shows up without restarting the workers
 '''
-app.layout = html.Div([
-    navbar_layout,
-    map_section,
-    footer_section
-])
+
+
+def serve_layout():
+    snapshot = refresh.current()
+    return html.Div([
+        navbar_layout,
+        create_map_section(snapshot),
+        create_progression_section(snapshot),
+        footer_section
+    ])
+
+
+app.layout = serve_layout
+refresh.start()
 
 if __name__ == '__main__':
     app.run_server(debug=True, threaded=True)
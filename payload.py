@@ -0,0 +1,52 @@
+import gzip
+import json
+import sys
+import time
+
+import plotly.io as pio
+
+
+def figure_bytes(fig):
+    """The figure as dash serializes it into the layout / callback response"""
+    return pio.to_json(fig, validate=False).encode()
+
+
+def measure(build, *args, repeat=5, **kwargs):
+    """Best-of-`repeat` build time plus raw and gzipped JSON size of the figure returned by `build`"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fig = build(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    payload = figure_bytes(fig)
+    serialize = time.perf_counter() - start
+
+    return {
+        'build_seconds': round(min(timings), 4),
+        'serialize_seconds': round(serialize, 4),
+        'json_bytes': len(payload),
+        'gzip_bytes': len(gzip.compress(payload, 6)),
+    }
+
+
+def compare_map(df):
+    """Text vs compact (hovertemplate/customdata) map figure for `df`"""
+    from main import getmap_fig
+
+    return {
+        'rows': len(df),
+        'text': measure(getmap_fig, df, compact=False),
+        'compact': measure(getmap_fig, df, compact=True),
+    }
+
+
+if __name__ == '__main__':
+    # python payload.py -- report for the frame the app renders on start
+    import refresh
+
+    timeline = refresh.current().timeline
+    frame = timeline.snapshot(len(timeline) - 1)
+    json.dump(compare_map(frame), sys.stdout, indent=2)
+    print()
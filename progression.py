@@ -0,0 +1,198 @@
+import hashlib
+import json
+import pathlib
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+PATH = pathlib.Path(__file__).parent
+MODEL_PARAMETERS = PATH.joinpath("data", "model_parameters.csv").resolve()
+
+# what the fit used but the parameters file lacks, optional:
+# {"standardize": {"time_1": [mean, std], "time_2": [mean, std]},
+#  "groups": {"<country_area>": {"country_grp_2": "grp 03", "tail_grp": "tail grp 01"}, ...}}
+# without it groups and scaling are estimated from the data and the projection is only illustrative
+MODEL_CONFIG = PATH.joinpath("data", "model_config.json").resolve()
+
+# devt_time (days since the area crossed the rate threshold) is split in two linear pieces: time_1 runs up
+# to TIME_SPLIT days ("Devt Time <=30"), time_2 counts the days after it ("Tail Devt Time >30")
+TIME_SPLIT = 30
+
+# days projected past the last date of covid.csv
+HORIZON = 30
+
+Z_95 = 1.959963984540054
+
+
+def parse_term(name):
+    """'country_grp_2[grp 01]:standardize(time_1)' -> [('factor', 'country_grp_2', 'grp 01'), ('standardize', 'time_1')]"""
+    parts = []
+    for part in name.split(':'):
+        factor = re.fullmatch(r'(\w+)\[(.+)\]', part)
+        standardized = re.fullmatch(r'standardize\((\w+)\)', part)
+        if factor:
+            parts.append(('factor',) + factor.groups())
+        elif standardized:
+            parts.append(('standardize', standardized.group(1)))
+        else:
+            parts.append(('variable', part))
+    return parts
+
+
+class Model:
+    """
+    model_parameters.csv compiled once into a design-matrix layout: one column per coefficient, each the
+    product of its factor indicators and (standardized) variables, scored for many rows in one product
+    """
+
+    def __init__(self, path=MODEL_PARAMETERS, config=MODEL_CONFIG):
+        config = pathlib.Path(config)
+        raw = config.read_bytes() if config.exists() else b''
+        # cached projections key on it, a new fit or config retires them
+        self.version = hashlib.sha1(pathlib.Path(path).read_bytes() + b'\0' + raw).hexdigest()[:12]
+
+        params = pd.read_csv(path)
+        self.names = params['col_name'].tolist()
+        self.terms = [parse_term(name) for name in self.names]
+        self.coef = params['coef'].to_numpy(dtype=float)
+        # the file has no covariances, the coefficients are taken as independent
+        self.var = params['w_stderr'].to_numpy(dtype=float) ** 2
+        self.levels = {}
+        for parts in self.terms:
+            for part in parts:
+                if part[0] == 'factor':
+                    self.levels.setdefault(part[1], [])
+                    if part[2] not in self.levels[part[1]]:
+                        self.levels[part[1]].append(part[2])
+
+        config = json.loads(raw) if raw else {}
+        self.scale = {name: tuple(values) for name, values in config['standardize'].items()} \
+            if 'standardize' in config else None
+        self.groups = config.get('groups')
+
+    @property
+    def illustrative(self):
+        """Whether groups or scaling have to be estimated, the output is then not the fitted model's"""
+        return self.scale is None or self.groups is None
+
+    def design(self, factors, variables, scale):
+        """
+        Design matrix for n rows: `factors` maps each factor to its level per row, `variables` each variable
+        to its values, `scale` each standardized variable to the (mean, std) of the data the model is applied to
+        """
+        n = len(next(iter(variables.values())))
+        X = np.ones((n, len(self.terms)))
+        for j, parts in enumerate(self.terms):
+            for part in parts:
+                if part[0] == 'factor':
+                    X[:, j] *= factors[part[1]] == part[2]
+                elif part[0] == 'standardize':
+                    mean, std = scale[part[1]]
+                    X[:, j] *= (variables[part[1]] - mean) / std
+                else:
+                    X[:, j] *= variables[part[1]]
+        return X
+
+    def score(self, X):
+        """Linear predictor and its 95% band for every row of X"""
+        fit = X @ self.coef
+        se = np.sqrt((X * X) @ self.var)
+        return fit, fit - Z_95 * se, fit + Z_95 * se
+
+
+def split_time(devt_time):
+    devt_time = np.asarray(devt_time, dtype=float)
+    return {'time_1': np.clip(devt_time, 0, TIME_SPLIT), 'time_2': np.clip(devt_time - TIME_SPLIT, 0, None)}
+
+
+def assign_groups(model, rates):
+    """
+    Model group of each area from its latest confirmed_cases_rate. The grouping used to fit the model is not
+    part of the data, so areas are cut into as many equal sized groups as country_grp_2 has levels, in rate
+    order, and the upper half of them share the second tail_grp level
+    """
+    groups = model.levels['country_grp_2']
+    tails = model.levels['tail_grp']
+    order = pd.Series(rates).rank(method='first', pct=True).to_numpy()
+    index = np.minimum((order * len(groups)).astype(int), len(groups) - 1)
+    return {'country_grp_2': np.array(groups, dtype=object)[index],
+            'tail_grp': np.array(tails, dtype=object)[index * len(tails) // len(groups)]}
+
+
+class Projection:
+    """Fit and 95% band of every area (rows) on every date (columns), NaN before the area's devt_time 0"""
+
+    def __init__(self, areas, dates, fit, lower, upper, last_observed, illustrative):
+        self.illustrative = illustrative
+        self.areas = areas
+        self.dates = dates
+        self.fit = fit
+        self.lower = lower
+        self.upper = upper
+        self.last_observed = last_observed
+
+
+def project(covid, model, horizon=HORIZON):
+    """
+    Score the model for every country / area of the covid query engine on every date, up to `horizon` days
+    past the data, as one (areas x dates) design matrix
+    """
+    data = covid.data
+    observed = data[data['devt_time'] >= 0]
+    # day 0 of each area, whichever of its rows it is read from
+    starts = (observed['date'] - pd.to_timedelta(observed['devt_time'], unit='D')) \
+        .groupby(observed['country_area'], observed=True).min()
+    latest = data.groupby('country_area', observed=True)['confirmed_cases_rate'].last()
+
+    if model.groups is not None:
+        # only the areas the fit had a group for
+        starts = starts[starts.index.isin(list(model.groups))]
+    areas = starts.index
+    dates = covid.dates.union(pd.date_range(covid.dates[-1], periods=horizon + 1)[1:])
+    devt = (dates.to_numpy()[None, :] - starts.to_numpy()[:, None]) / np.timedelta64(1, 'D')
+
+    scale = model.scale
+    if scale is None:
+        # standardize() memorizes the mean / std of the data it is applied to, the current data stands in
+        times = split_time(observed['devt_time'])
+        scale = {name: (values.mean(), values.std()) for name, values in times.items()}
+
+    if model.groups is None:
+        groups = assign_groups(model, latest.reindex(areas).to_numpy())
+    else:
+        groups = {factor: np.array([model.groups[area][factor] for area in areas], dtype=object)
+                  for factor in model.levels}
+    factors = {factor: np.repeat(levels, len(dates)) for factor, levels in groups.items()}
+    X = model.design(factors, split_time(devt.ravel()), scale)
+    fit, lower, upper = (np.where(devt >= 0, values.reshape(devt.shape), np.nan) for values in model.score(X))
+    return Projection(pd.Index(areas), dates, fit, lower, upper, covid.dates[-1], model.illustrative)
+
+
+def report():
+    """Compile / score time and result size for the snapshot the app serves"""
+    import refresh
+
+    covid = refresh.current().covid
+    start = time.perf_counter()
+    model = Model()
+    compiled = time.perf_counter() - start
+    start = time.perf_counter()
+    projection = project(covid, model)
+    scored = time.perf_counter() - start
+    return {
+        'coefficients': len(model.names),
+        'illustrative': model.illustrative,
+        'areas': len(projection.areas),
+        'dates': len(projection.dates),
+        'compile_seconds': round(compiled, 4),
+        'score_seconds': round(scored, 4),
+    }
+
+
+if __name__ == '__main__':
+    # python progression.py -- timings of the projection for the current data
+    json.dump(report(), sys.stdout, indent=2)
+    print()
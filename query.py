@@ -0,0 +1,125 @@
+import functools
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+PATH = pathlib.Path(__file__).parent
+COVID_CSV = PATH.joinpath("data", "covid.csv").resolve()
+
+# filter / split dimensions as labelled in the UI (see constants.md1), AREA falls back
+# to the country for countries without area level data, which is what country_area holds
+DIMENSIONS = {'REGION': 'region', 'SUB-REGION': 'subregion', 'COUNTRY': 'country', 'AREA': 'country_area'}
+
+ADDITIVE = ['confirmed_cases', 'deaths', 'recovered', 'active', 'population']
+
+# rates are recomputed from the aggregated counts, never summed
+RATES = {
+    'confirmed_cases_rate': ('confirmed_cases', 'population'),
+    'deaths_rate': ('deaths', 'confirmed_cases'),
+    'recovered_rate': ('recovered', 'confirmed_cases'),
+    'active_rate': ('active', 'confirmed_cases'),
+}
+
+
+def load_covid(path=COVID_CSV):
+    dtype = {column: 'category' for column in DIMENSIONS.values()}
+    # area is empty for most countries, left to inference pandas sees mixed types
+    dtype['area'] = str
+    data = pd.read_csv(path, encoding='utf-8-sig', dtype=dtype)
+    data['date'] = pd.to_datetime(data['date'], format='%d/%m/%Y')
+    return data.sort_values(['country_area', 'date']).reset_index(drop=True)
+
+
+class CovidQuery:
+    """
+    Filter union / split / top N over the covid.csv timeline.
+
+    Every dimension is held as categorical codes with a code -> rows index, so a query
+    resolves to one row mask and one bincount over (group, date) codes. Results are
+    memoized per normalized query and shared between callers, treat them as read-only.
+    """
+
+    def __init__(self, data, cache_size=256):
+        self.data = data
+        dates = pd.Categorical(data['date'])
+        self.dates = pd.DatetimeIndex(dates.categories)
+        self.date_codes = dates.codes.astype(np.int64)
+
+        self.codes, self.categories, self.index = {}, {}, {}
+        for column in DIMENSIONS.values():
+            values = data[column].cat
+            codes = values.codes.to_numpy()
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(values.categories) + 1))
+            self.codes[column] = codes.astype(np.int64)
+            self.categories[column] = values.categories
+            self.index[column] = {name: order[bounds[i]:bounds[i + 1]] for i, name in enumerate(values.categories)}
+
+        self.measures = {column: data[column].to_numpy(dtype=float) for column in ADDITIVE}
+        self.cache_size = cache_size
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._run)
+
+    @staticmethod
+    def normalize(filters=None, split=None, top=None, measure='confirmed_cases'):
+        filters = filters or {}
+        # a single value may come as a plain string, set() would split it into characters
+        key = tuple(sorted((DIMENSIONS.get(dimension, dimension),
+                            tuple(sorted(set([values] if isinstance(values, str) else values))))
+                           for dimension, values in filters.items() if values))
+        split = DIMENSIONS.get(split, split) if split else None
+        if measure not in ADDITIVE and measure not in RATES:
+            raise ValueError('unknown measure {!r}'.format(measure))
+        # no limit for an empty, zero or negative top, slicing with it would drop groups from the end instead
+        top = int(top) if top and int(top) > 0 else None
+        return key, split, top, measure
+
+    def mask(self, filters):
+        """Union of the selected values over all filters, everything when no filter is set"""
+        if not filters:
+            return np.ones(len(self.data), dtype=bool)
+        mask = np.zeros(len(self.data), dtype=bool)
+        for column, values in filters:
+            index = self.index[column]
+            for value in values:
+                if value in index:
+                    mask[index[value]] = True
+        return mask
+
+    def run(self, filters=None, split=None, top=None, measure='confirmed_cases'):
+        """
+        `measure` per date (index) and split group (columns, ordered by their peak), for the union of
+        `filters` ({dimension: [values]}); a single 'total' column without split
+        """
+        return self._cached(*self.normalize(filters, split, top, measure))
+
+    def _totals(self, rows, groups, count):
+        n_dates = len(self.dates)
+        bins = groups * n_dates + self.date_codes[rows]
+        return {column: np.bincount(bins, weights=values[rows], minlength=count * n_dates).reshape(count, n_dates)
+                for column, values in self.measures.items()}
+
+    def _run(self, filters, split, top, measure):
+        rows = np.flatnonzero(self.mask(filters))
+        if split:
+            groups = self.codes[split][rows]
+            names = self.categories[split]
+        else:
+            groups = np.zeros(len(rows), dtype=np.int64)
+            names = pd.Index(['total'])
+        totals = self._totals(rows, groups, len(names))
+
+        if measure in RATES:
+            numerator, denominator = RATES[measure]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.where(totals[denominator] > 0, totals[numerator] / totals[denominator], 0.0)
+        else:
+            values = totals[measure]
+
+        present = np.flatnonzero(np.bincount(groups, minlength=len(names)))
+        present = present[np.argsort(-values[present].max(axis=1), kind='stable')]
+        if top:
+            present = present[:top]
+
+        return pd.DataFrame(values[present].T, index=self.dates, columns=names[present])
+
@@ -0,0 +1,254 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import columnar
+import geometry
+from query import DIMENSIONS, CovidQuery
+from timeline import MAP_COLUMNS, Timeline
+
+logger = logging.getLogger(__name__)
+
+# new daily county extracts (same columns as the pickled data source) are dropped here
+EXTRACTS_PATH = columnar.DATA_PATH.joinpath("extracts")
+
+# seconds between two looks at data/, 0 turns the background refresh off
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 60))
+
+# confirmed cases per million from which covid.csv flags an area (C_xs_T) and starts its devt_time
+RATE_THRESHOLD = 5
+NO_DEVT_TIME = -99
+
+
+class Snapshot:
+    """Everything a request reads, built once and never modified; a refresh swaps in a new one"""
+
+    def __init__(self, timeline, covid, geometry, parts):
+        self.timeline = timeline
+        self.covid = covid
+        # county shapes matching timeline.fips
+        self.geometry = geometry
+        self.version = hashlib.sha1(repr(parts).encode()).hexdigest()[:12]
+
+
+def rank_directions(frame):
+    """Whether each '* rank' column ranks its base column ascending, learnt from the data already ranked"""
+    directions = {}
+    for column in frame.columns:
+        base = column[:-len(' rank')]
+        if column.endswith(' rank') and base in frame.columns:
+            directions[column] = bool(frame[base].rank().corr(frame[column]) >= 0)
+    return directions
+
+
+def add_ranks(delta, directions):
+    """Percentile ranks (0-100) within each date, only the dates of `delta` are ranked"""
+    for column, ascending in directions.items():
+        ranks = delta.groupby('date')[column[:-len(' rank')]].rank(pct=True, ascending=ascending) * 100
+        ranks = ranks.round()
+        delta[column] = ranks if ranks.isna().any() else ranks.astype(np.int64)
+    return delta
+
+
+def derive_covid(delta, crossings):
+    """
+    Fill the derived covid.csv columns of newly appended rows. `crossings` (country_area -> first date
+    over RATE_THRESHOLD) is updated in place, the areas crossing for the first time are returned since
+    their earlier rows need a devt_time too
+    """
+    confirmed = delta['confirmed_cases']
+    delta['active'] = (confirmed - delta['deaths'] - delta['recovered']).clip(lower=0)
+    delta['confirmed_cases_rate'] = (confirmed / delta['population'].where(delta['population'] > 0)).fillna(0)
+    for rate, column in (('deaths_rate', 'deaths'), ('recovered_rate', 'recovered'), ('active_rate', 'active')):
+        delta[rate] = (delta[column] / confirmed.where(confirmed > 0)).fillna(0)
+    delta['C_xs_T'] = (delta['confirmed_cases_rate'] >= RATE_THRESHOLD).astype(np.int64)
+
+    first = delta[delta['C_xs_T'] == 1].groupby('country_area', observed=True)['date'].min()
+    crossed = [area for area in first.index if area not in crossings or first[area] < crossings[area]]
+    crossings.update({area: first[area] for area in crossed})
+    delta['devt_time'] = devt_time(delta, crossings)
+    return delta, crossed
+
+
+def devt_time(frame, crossings):
+    start = pd.to_datetime(frame['country_area'].astype(object).map(crossings))
+    return (frame['date'] - start).dt.days.fillna(NO_DEVT_TIME).astype(np.int64)
+
+
+class CsvTail:
+    """Byte offset into an append-only csv, so a refresh parses only the lines added since the last one"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header = f.readline()
+            f.seek(0, os.SEEK_END)
+            self.offset = f.tell()
+        self.columns = pd.read_csv(io.BytesIO(self.header), encoding='utf-8-sig').columns
+
+    def read(self):
+        """New complete lines as a frame, None when the file was rewritten rather than appended to"""
+        with open(self.path, 'rb') as f:
+            if f.readline() != self.header:
+                return None
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < self.offset:
+                return None
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        # a half written last line waits for the next poll
+        chunk = chunk[:chunk.rfind(b'\n') + 1]
+        if not chunk.strip():
+            return pd.DataFrame(columns=self.columns)
+        delta = pd.read_csv(io.BytesIO(chunk), header=None, names=self.columns)
+        delta['date'] = pd.to_datetime(delta['date'], format='%d/%m/%Y')
+        # only once parsed, a chunk that fails is read again by the next poll
+        self.offset += len(chunk)
+        return delta
+
+
+class Refresher:
+    """
+    Holds the current Snapshot and folds new data into it: county extracts appearing in data/extracts
+    and lines appended to covid.csv are processed on their own and appended to the previous snapshot,
+    a rewritten source triggers a full reload of that source only
+    """
+
+    def __init__(self):
+        self.signatures = {}
+        self.load_counties()
+        self.load_covid()
+        self.current = self.snapshot()
+
+    @staticmethod
+    def signature(path):
+        stat = path.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    def snapshot(self):
+        parts = (self.counties_version, self.geometry.name, self.extracts, self.covid_version, self.tail.offset)
+        return Snapshot(self.timeline, self.covid, self.geometry, parts)
+
+    def load_counties(self):
+        signature = self.signature(columnar.SOURCES['counties'])
+        store = columnar.open_store('counties')
+        timeline = Timeline(store.frame(MAP_COLUMNS))
+        # a FIPS set the geometry artifact has no shapes for raises here, before anything is swapped
+        self.geometry = geometry.counties_artifact(timeline.fips)
+        self.signatures['counties'] = signature
+        self.counties_version = store.version
+        self.directions = None
+        self.timeline = timeline
+        self.extracts = []
+        self.add_extracts()
+
+    def add_extracts(self):
+        paths = sorted(EXTRACTS_PATH.glob('*.pkl')) if EXTRACTS_PATH.exists() else []
+        new = [path for path in paths if path.name not in self.extracts]
+        for path in new:
+            self.timeline = self.timeline.extend(self.county_delta(path))
+            self.extracts.append(path.name)
+        return bool(new)
+
+    def county_delta(self, path):
+        # the derived extract is kept in the columnar store, so other workers and restarts reuse it
+        target = columnar.STORE_PATH.joinpath('extracts', columnar.source_version(path))
+        if target.exists():
+            return columnar.Store(target).frame(MAP_COLUMNS)
+        delta = pd.read_pickle(path)
+        delta = delta[delta['date'] > self.timeline.dates[-1]].reset_index(drop=True)
+        if self.directions is None:
+            # only the rank columns and their bases are decoded
+            store = columnar.open_store('counties')
+            ranked = [column for column in store.columns
+                      if column.endswith(' rank') and column[:-len(' rank')] in store.columns]
+            self.directions = rank_directions(store.frame(ranked + [column[:-len(' rank')] for column in ranked]))
+        delta = add_ranks(delta, self.directions)
+        columnar.ingest('extracts', delta, source=path)
+        return delta[MAP_COLUMNS]
+
+    def load_covid(self):
+        path = columnar.SOURCES['covid']
+        self.signatures['covid'] = self.signature(path)
+        self.tail = CsvTail(path)
+        store = columnar.open_store('covid')
+        self.covid_version = store.version
+        self.covid = CovidQuery(store.frame())
+        crossed = self.covid.data[self.covid.data['C_xs_T'] == 1]
+        self.crossings = crossed.groupby('country_area', observed=True)['date'].min().to_dict()
+
+    def add_covid(self):
+        delta = self.tail.read()
+        if delta is None:
+            self.load_covid()
+            return True
+        if delta.empty:
+            return False
+        delta, crossed = derive_covid(delta, self.crossings)
+        # rebuilding the engine over the concatenated rows is cheaper than merging its indexes; both sides
+        # get the same (sorted, like a fresh load) categories so the concat stays categorical
+        history = self.covid.data
+        dtypes = {}
+        for column in DIMENSIONS.values():
+            categories = history[column].cat.categories.union(pd.Index(delta[column].dropna().unique()))
+            dtypes[column] = pd.CategoricalDtype(categories)
+        data = pd.concat([history.astype(dtypes), delta.astype(dtypes)], ignore_index=True)
+        if crossed:
+            rows = data['country_area'].isin(crossed)
+            data.loc[rows, 'devt_time'] = devt_time(data[rows], self.crossings)
+        self.covid = CovidQuery(data)
+        return True
+
+    def poll(self):
+        """Fold whatever changed in data/ into a new snapshot, returns whether one was swapped in"""
+        changed = False
+        if self.signature(columnar.SOURCES['counties']) != self.signatures['counties']:
+            self.load_counties()
+            changed = True
+        else:
+            changed |= self.add_extracts()
+        # taken before reading, a line finished while add_covid runs changes the file again
+        signature = self.signature(columnar.SOURCES['covid'])
+        if signature != self.signatures['covid']:
+            changed |= self.add_covid()
+            self.signatures['covid'] = signature
+        if changed:
+            # requests already running keep the snapshot they started with
+            self.current = self.snapshot()
+            logger.info('data refreshed to snapshot %s', self.current.version)
+        return changed
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('data refresh failed, keeping snapshot %s', self.current.version)
+
+
+_refresher = None
+
+
+def refresher():
+    global _refresher
+    if _refresher is None:
+        _refresher = Refresher()
+    return _refresher
+
+
+def current():
+    """The snapshot to serve this request from, read it once per request"""
+    return refresher().current
+
+
+def start(interval=REFRESH_INTERVAL):
+    if interval > 0:
+        threading.Thread(target=refresher().run, args=(interval,), name='data-refresh', daemon=True).start()
@@ -0,0 +1,97 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+import columnar
+from refresh import add_ranks, derive_covid, rank_directions
+
+COVID_COLUMNS = ['region', 'subregion', 'country', 'area', 'country_area', 'date', 'confirmed_cases', 'deaths',
+                 'recovered', 'population', 'lat', 'long', 'lat_long_flag', 'pop_flag', 'active',
+                 'confirmed_cases_rate', 'deaths_rate', 'recovered_rate', 'active_rate', 'C_xs_T', 'devt_time']
+
+# numeric county columns that stay fixed over time (demographics), everything else drifts day to day
+STATIC_COLUMNS = ['% people older than 60', 'Median income', '% African Americans', '% Hispanic Americans',
+                  '% Male', 'Population density', 'Employment density', 'Population']
+
+
+def counties_frame(counties=3142, days=30, start='2020-03-01', seed=0):
+    """
+    County x date frame with the schema of data/columns.txt. The real counties are the template so the
+    FIPS codes match the geometry artifact; values drift with a random walk and ranks are recomputed per date
+    """
+    rng = np.random.default_rng(seed)
+    template = pd.read_pickle(columnar.SOURCES['counties']).reset_index(drop=True)
+    if counties > len(template):
+        # every county needs a real FIPS code with a shape, there are no more to hand out
+        raise ValueError('at most {} counties, {} asked'.format(len(template), counties))
+    directions = rank_directions(template)
+    template = template.iloc[:counties]
+
+    frame = template.loc[np.tile(template.index, days)].reset_index(drop=True)
+    frame['date'] = np.repeat(pd.date_range(start, periods=days), len(template)).astype('datetime64[ns]')
+
+    # multiplicative random walk per county, shared by every drifting column
+    walk = np.exp(np.cumsum(rng.normal(0, 0.03, (days, len(template))), axis=0)).ravel()
+    for column in frame.columns:
+        if column in STATIC_COLUMNS or column in directions or not pd.api.types.is_numeric_dtype(frame[column]):
+            continue
+        values = frame[column].to_numpy(dtype=float) * walk
+        if pd.api.types.is_integer_dtype(frame[column]):
+            values = np.round(values).astype(np.int64)
+        frame[column] = values
+    frame['npi_score'] = np.clip(frame['npi_score'] * walk, 0, 1).round(2)
+    return add_ranks(frame, directions)
+
+
+def covid_frame(countries=200, days=365, start='2020-01-22', areas=(('United States', 52), ('China', 31)), seed=0):
+    """covid.csv style timeline: cumulative logistic outbreaks per country / area with the derived columns filled"""
+    rng = np.random.default_rng(seed)
+    names = ['Country {:03d}'.format(i) for i in range(countries - len(areas))] + [name for name, _ in areas]
+    places = []
+    for index, country in enumerate(names):
+        split = dict(areas).get(country, 0)
+        region, subregion = 'Region {}'.format(index % 9), 'Subregion {}'.format(index % 23)
+        for area in ['{} {:02d}'.format(country[:2].upper(), i) for i in range(split)] or [np.nan]:
+            label = country if pd.isna(area) else '{} - {}'.format(country, area)
+            places.append((region, subregion, country, area, label))
+
+    dates = pd.date_range(start, periods=days)
+    n = len(places)
+    t = np.arange(days)[None, :]
+    cap = rng.lognormal(8, 2, (n, 1))
+    onset = rng.uniform(0, days, (n, 1))
+    confirmed = np.floor(cap / (1 + np.exp(-(t - onset) / rng.uniform(5, 20, (n, 1))))).astype(np.int64)
+    deaths = np.floor(confirmed * rng.uniform(0.01, 0.1, (n, 1))).astype(np.int64)
+    recovered = np.floor(np.concatenate([np.zeros((n, 14)), confirmed[:, :-14]], axis=1)[:, :days] * 0.8)
+
+    frame = pd.DataFrame(np.repeat(places, days, axis=0), columns=COVID_COLUMNS[:5])
+    frame['area'] = frame['area'].replace('nan', np.nan)
+    frame['date'] = np.tile(dates, n)
+    frame['confirmed_cases'] = confirmed.ravel()
+    frame['deaths'] = deaths.ravel()
+    frame['recovered'] = recovered.ravel().astype(np.int64)
+    frame['population'] = np.repeat(rng.uniform(0.1, 300, n).round(6), days)
+    frame['lat'] = np.repeat(rng.uniform(-60, 70, n).round(6), days)
+    frame['long'] = np.repeat(rng.uniform(-180, 180, n).round(6), days)
+    frame['lat_long_flag'] = 1
+    frame['pop_flag'] = 1
+    frame, _ = derive_covid(frame, {})
+    return frame[COVID_COLUMNS]
+
+
+def write(directory, counties=3142, days=30, countries=200, covid_days=365):
+    """Write a data folder the app can be pointed at with COVID_DATA_PATH"""
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    counties_frame(counties, days).to_pickle(directory.joinpath('pickled_data_source'))
+    covid = covid_frame(countries, covid_days)
+    covid['date'] = covid['date'].dt.strftime('%d/%m/%Y')
+    covid.to_csv(directory.joinpath('covid.csv'), index=False, encoding='utf-8-sig', float_format='%.9f')
+    return directory
+
+
+if __name__ == '__main__':
+    # python synthetic.py <directory> [counties] [days] [countries] [covid_days]
+    print(write(sys.argv[1], *map(int, sys.argv[2:])))
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import columnar
+import refresh
+import synthetic
+from query import CovidQuery
+
+COUNTY_DAYS, EXTRACT_DAYS = 5, 2
+COVID_DAYS, APPENDED_DAYS = 80, 20
+
+
+def point_at(monkeypatch, directory):
+    monkeypatch.setattr(columnar, 'SOURCES', {'counties': directory / 'pickled_data_source',
+                                              'covid': directory / 'covid.csv'})
+    monkeypatch.setattr(columnar, 'STORE_PATH', directory / 'store')
+    monkeypatch.setattr(refresh, 'EXTRACTS_PATH', directory / 'extracts')
+
+
+def write_covid(frame, path, **kwargs):
+    frame = frame.copy()
+    frame['date'] = frame['date'].dt.strftime('%d/%m/%Y')
+    frame.to_csv(path, index=False, encoding='utf-8-sig', float_format='%.9f', **kwargs)
+
+
+@pytest.fixture(scope='module')
+def data():
+    counties = synthetic.counties_frame(counties=200, days=COUNTY_DAYS + EXTRACT_DAYS)
+    covid = synthetic.covid_frame(countries=30, days=COVID_DAYS + APPENDED_DAYS)
+    return counties, covid
+
+
+def test_incremental_refresh_matches_full_load(data, tmp_path, monkeypatch):
+    counties, covid = data
+    extract_start = counties['date'].unique()[COUNTY_DAYS]
+    append_start = covid['date'].unique()[COVID_DAYS]
+
+    # incremental: base sources, then an extract and appended covid.csv lines folded in by a poll
+    incremental = tmp_path / 'incremental'
+    incremental.mkdir()
+    counties[counties['date'] < extract_start].to_pickle(incremental / 'pickled_data_source')
+    base, _ = refresh.derive_covid(covid[covid['date'] < append_start].copy(), {})
+    write_covid(base, incremental / 'covid.csv')
+    point_at(monkeypatch, incremental)
+    refresher = refresh.Refresher()
+
+    (incremental / 'extracts').mkdir()
+    counties[counties['date'] >= extract_start].to_pickle(incremental / 'extracts' / 'extract.pkl')
+    write_covid(covid[covid['date'] >= append_start], incremental / 'covid.csv', mode='a', header=False)
+    assert refresher.poll()
+    updated = refresher.current
+
+    # full: the same data written out in one go
+    full = tmp_path / 'full'
+    full.mkdir()
+    counties.to_pickle(full / 'pickled_data_source')
+    write_covid(covid, full / 'covid.csv')
+    point_at(monkeypatch, full)
+    fresh = refresh.Refresher().current
+
+    assert updated.version != fresh.version
+    assert updated.geometry.name == fresh.geometry.name
+    assert updated.timeline.dates.equals(fresh.timeline.dates)
+    np.testing.assert_array_equal(updated.timeline.fips, fresh.timeline.fips)
+    for column, values in fresh.timeline.values.items():
+        np.testing.assert_array_equal(updated.timeline.values[column], values)
+    assert (updated.timeline.zmin, updated.timeline.zmax) == (fresh.timeline.zmin, fresh.timeline.zmax)
+
+    key = ['country_area', 'date']
+    updated_rows = updated.covid.data.astype({'country_area': str}).sort_values(key).reset_index(drop=True)
+    fresh_rows = fresh.covid.data.astype({'country_area': str}).sort_values(key).reset_index(drop=True)
+    np.testing.assert_array_equal(updated_rows['devt_time'], fresh_rows['devt_time'])
+    np.testing.assert_array_equal(updated_rows['C_xs_T'], fresh_rows['C_xs_T'])
+
+    assert isinstance(updated.covid, CovidQuery)
+    for query in ({}, {'split': 'COUNTRY', 'top': 5},
+                  {'filters': {'REGION': ['Region 1', 'Region 2']}, 'split': 'AREA', 'measure': 'deaths_rate'}):
+        pd.testing.assert_frame_equal(updated.covid.run(**query), fresh.covid.run(**query))
+
+
+def test_failed_chunk_is_read_again(data, tmp_path):
+    _, covid = data
+    path = tmp_path / 'covid.csv'
+    rows, _ = refresh.derive_covid(covid[covid['date'] < covid['date'].unique()[COVID_DAYS]].copy(), {})
+    write_covid(rows.iloc[:10], path)
+    tail = refresh.CsvTail(path)
+
+    write_covid(rows.iloc[10:12], path, mode='a', header=False)
+    with open(path, 'a') as f:
+        f.write(','.join('31/02/2020' if column == 'date' else '0' for column in tail.columns) + '\n')
+    with pytest.raises(ValueError):
+        tail.read()
+
+    # the bad line is fixed in place: the valid lines before it are not lost
+    text = path.read_text(encoding='utf-8-sig').replace('31/02/2020', '28/02/2020')
+    path.write_text(text, encoding='utf-8-sig')
+    assert len(tail.read()) == 3
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+# columns the map needs per date: the choropleth value plus the hover metrics
+TIMELINE_COLUMNS = ['npi_score', 'Social distancing index', 'Imported COVID cases']
+
+# everything the map section reads from the county frame
+MAP_COLUMNS = ['CTFIPS', 'date', 'state'] + TIMELINE_COLUMNS
+
+
+class Timeline:
+    """
+    Dense county x date matrices of the map columns, built once from the long CTFIPS x date frame.
+
+    The matrices are views over buffers; the first extend() reallocates them with spare date rows
+    so later ones append new dates without copying the history. Earlier Timeline objects keep seeing
+    only their own dates.
+    """
+
+    def __init__(self, df, columns=TIMELINE_COLUMNS):
+        fips = pd.Categorical(df['CTFIPS'])
+        dates = pd.Categorical(df['date'])
+        self.fips = np.asarray(fips.categories)
+        self.dates = pd.DatetimeIndex(dates.categories)
+        self.integer = [column for column in columns if pd.api.types.is_integer_dtype(df[column])]
+
+        # county attributes that do not change over time
+        self.state = df.groupby(fips.codes)['state'].first().reindex(range(len(self.fips))).to_numpy()
+
+        # sized exactly, spare rows are only worth it once the data actually grows
+        self._buffers = {column: np.full((len(self.dates), len(self.fips)), np.nan) for column in columns}
+        self._fill(0, dates.codes, fips.codes, df)
+        self.zmin = np.nanmin(self.values['npi_score'])
+        self.zmax = np.nanmax(self.values['npi_score'])
+
+    def _fill(self, start, rows, cols, df):
+        for column, buffer in self._buffers.items():
+            buffer[start + rows, cols] = df[column].to_numpy(dtype=float)
+        self.values = {column: buffer[:len(self.dates)] for column, buffer in self._buffers.items()}
+
+    def extend(self, delta):
+        """
+        A new Timeline with the dates of `delta` (all later than the current last date) appended;
+        counties unknown to this timeline are dropped since the map has no shape for them
+        """
+        delta = delta[delta['CTFIPS'].isin(self.fips) & (delta['date'] > self.dates[-1])]
+        if delta.empty:
+            return self
+        dates = pd.Categorical(delta['date'])
+        cols = pd.Index(self.fips).get_indexer(delta['CTFIPS'])
+
+        extended = object.__new__(Timeline)
+        extended.__dict__.update(self.__dict__)
+        extended.dates = self.dates.append(pd.DatetimeIndex(dates.categories))
+        extended._buffers = dict(self._buffers)
+        for column, buffer in self._buffers.items():
+            if len(buffer) < len(extended.dates):
+                grown = np.full((len(extended.dates) * 2, buffer.shape[1]), np.nan)
+                grown[:len(self.dates)] = buffer[:len(self.dates)]
+                extended._buffers[column] = grown
+            else:
+                # rows past len(self.dates) are not visible to self, a stale row from an
+                # abandoned extend is simply overwritten
+                buffer[len(self.dates):len(extended.dates)] = np.nan
+        extended._fill(len(self.dates), dates.codes, cols, delta)
+
+        new = extended.values['npi_score'][len(self.dates):]
+        extended.zmin = np.fmin(self.zmin, np.nanmin(new))
+        extended.zmax = np.fmax(self.zmax, np.nanmax(new))
+        return extended
+
+    def __len__(self):
+        return len(self.dates)
+
+    def label(self, index):
+        return self.dates[index].strftime('%d %b %Y')
+
+    def snapshot(self, index):
+        """The map frame for one date, in the same county order for every date"""
+        frame = pd.DataFrame({column: matrix[index] for column, matrix in self.values.items()})
+        frame[self.integer] = frame[self.integer].astype('Int64')
+        frame.insert(0, 'CTFIPS', self.fips)
+        frame.insert(1, 'state', self.state)
+        frame['date'] = self.dates[index]
+        return frame
+
+    def marks(self, count=6):
+        step = max(1, len(self.dates) // count)
+        return {int(i): self.dates[i].strftime('%d %b') for i in range(0, len(self.dates), step)}